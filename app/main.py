@@ -1,15 +1,23 @@
 import os
 import re
+import time
 import uuid
-import json
+import hashlib
 import shutil
 import subprocess
 import threading
+import traceback
+import logging
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
+import orjson
 from fastapi import FastAPI, UploadFile, File, Form, Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, ORJSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
@@ -18,15 +26,51 @@ APP_VERSION = "v0.6.2"
 APP_DIR = Path(__file__).resolve().parent
 ENGINE = Path("/srv/engine/clearscan_engine.py")
 
+logger = logging.getLogger("uvicorn.error")
+
+
+def load_engine():
+    # Importing the engine once avoids a fresh interpreter per job; fall back to a subprocess if it won't load.
+    try:
+        spec = importlib.util.spec_from_file_location("clearscan_engine", ENGINE)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        return mod
+    except Exception:
+        logger.exception("Could not import engine from %s; jobs will run it as a subprocess", ENGINE)
+        return None
+
+
+ENGINE_MOD = load_engine()
+
 JOBS_DIR = Path(os.getenv("JOBS_DIR", "/data/jobs"))
 MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "500"))
+UPLOAD_CHUNK_BYTES = 1 << 20
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "3"))
+
+_SAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9._ -]+")
+_WS_RE = re.compile(r"\s+")
 
-app = FastAPI(title="ClearScan OSS Web")
+app = FastAPI(title="ClearScan OSS Web", default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory=str(APP_DIR / "static")), name="static")
 templates = Jinja2Templates(directory=str(APP_DIR / "templates"))
 
 JOBS_DIR.mkdir(parents=True, exist_ok=True)
 
+# Each job drives a heavy ocrmypdf child; cap how many run at once and let the rest queue.
+JOB_POOL = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="clearscan-job")
+
+
+# job_id -> (file signature key, serialized /api/status body, state, etag)
+STATUS_CACHE: dict[str, tuple[tuple, bytes, str | None, str]] = {}
+STATUS_CACHE_LOCK = threading.Lock()
+
+
+@app.on_event("shutdown")
+def shutdown_job_pool():
+    # Drop queued jobs so shutdown doesn't wait for the whole backlog; running ones are left to finish.
+    JOB_POOL.shutdown(wait=False, cancel_futures=True)
+
 
 def job_paths(job_id: str) -> dict:
     base = JOBS_DIR / job_id
@@ -46,8 +90,8 @@ def safe_filename(name: str) -> str:
     name = name.replace("\\", "/").split("/")[-1]
     if not name.lower().endswith(".pdf"):
         name += ".pdf"
-    name = re.sub(r"[^A-Za-z0-9._ -]+", "_", name)
-    name = re.sub(r"\s+", " ", name).strip()
+    name = _SAFE_CHARS_RE.sub("_", name)
+    name = _WS_RE.sub(" ", name).strip()
     return name[:180] or "document.pdf"
 
 
@@ -61,10 +105,41 @@ def iso_now() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
 
+def file_sig(p: Path) -> tuple[int, int, int]:
+    # st_ino changes on every os.replace, so same-tick rewrites still differ on coarse-mtime filesystems.
+    try:
+        st = p.stat()
+    except FileNotFoundError:
+        return (0, 0, 0)
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+
+def tail_lines(path: Path, n: int = 300, window: int = 65536, max_window: int = 4 << 20) -> str:
+    size = path.stat().st_size
+    with path.open("rb") as f:
+        while True:
+            start = max(0, size - window)
+            f.seek(start)
+            lines = f.read().decode("utf-8", errors="ignore").splitlines()
+            # The first line of a mid-file window is usually partial; keep it only if we read from the start.
+            if start > 0:
+                lines = lines[1:]
+            if len(lines) >= n or start == 0 or window >= max_window:
+                return "\n".join(lines[-n:])
+            window *= 2
+
+
 def write_status(p: Path, state: str, **extra):
     payload = {"state": state, "ts": iso_now(), **extra}
-    p.parent.mkdir(parents=True, exist_ok=True)
-    p.write_text(json.dumps(payload, indent=2), encoding="utf-8")
+    data = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+    # Write a sibling and rename so /api/status never reads a half-written file.
+    tmp = p.with_suffix(".json.tmp")
+    try:
+        tmp.write_bytes(data)
+    except FileNotFoundError:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_bytes(data)
+    os.replace(tmp, p)
 
 
 def run_job(job_id: str, lang: str, mode: str, force_ocr: bool, output_type: str, optimize: str):
@@ -97,16 +172,39 @@ def run_job(job_id: str, lang: str, mode: str, force_ocr: bool, output_type: str
     base.mkdir(parents=True, exist_ok=True)
 
     with log_path.open("w", encoding="utf-8") as log:
-        log.write("Running:\n" + " ".join(cmd) + "\n\n")
-        log.flush()
-        proc = subprocess.Popen(
-            cmd,
-            stdout=log,
-            stderr=subprocess.STDOUT,
-            text=True,
-            cwd=str(base),
-        )
-        rc = proc.wait()
+        if ENGINE_MOD is not None:
+            log.write(f"Engine: {ENGINE} (in-process)\n\n")
+            try:
+                ENGINE_MOD.process(
+                    paths["input"],
+                    out_pdf,
+                    lang=lang,
+                    mode=mode,
+                    force_ocr=force_ocr,
+                    output_type=output_type,
+                    optimize=optimize,
+                    cwd=base,
+                    log=log,
+                )
+                rc = 0
+            except ValueError as e:
+                # Bad form values; mirror the CLI's argparse usage-error exit code.
+                log.write(f"error: {e}\n")
+                rc = 2
+            except Exception:
+                log.write(traceback.format_exc())
+                rc = 1
+        else:
+            log.write("Running:\n" + " ".join(cmd) + "\n\n")
+            log.flush()
+            proc = subprocess.Popen(
+                cmd,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                text=True,
+                cwd=str(base),
+            )
+            rc = proc.wait()
 
     if rc == 0 and out_pdf.exists():
         in_size = paths["input"].stat().st_size if paths["input"].exists() else None
@@ -130,19 +228,58 @@ def run_job(job_id: str, lang: str, mode: str, force_ocr: bool, output_type: str
         write_status(paths["status"], "error", exit_code=rc)
 
 
-def create_job_from_upload(file: UploadFile, contents: bytes, lang: str, mode: str, force_ocr: bool, output_type: str, optimize: str):
-    size_mb = len(contents) / (1024 * 1024)
-    if size_mb > MAX_UPLOAD_MB:
+def mark_job_error(job_id: str, error: str):
+    status_path = job_paths(job_id)["status"]
+    if not status_path.parent.exists():
+        return
+    try:
+        write_status(status_path, "error", error=error)
+    except OSError:
+        logger.exception("Could not record error status for job %s", job_id)
+
+
+def on_job_done(job_id: str, future):
+    # Pool futures are never read, so this is the only place a job's own failure can surface.
+    if future.cancelled():
+        mark_job_error(job_id, "Cancelled: server shut down before the job started")
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Job %s failed", job_id, exc_info=exc)
+        mark_job_error(job_id, f"{type(exc).__name__}: {exc}")
+
+
+async def save_upload(file: UploadFile, dest: Path) -> int | None:
+    limit = MAX_UPLOAD_MB * 1024 * 1024
+    total = 0
+    with dest.open("wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            total += len(chunk)
+            if total > limit:
+                break
+            await run_in_threadpool(out.write, chunk)
+    if total > limit:
+        dest.unlink(missing_ok=True)
+        return None
+    return total
+
+
+async def create_job_from_upload(file: UploadFile, lang: str, mode: str, force_ocr: bool, output_type: str, optimize: str):
+    if file.size is not None and file.size > MAX_UPLOAD_MB * 1024 * 1024:
+        size_mb = file.size / (1024 * 1024)
         return None, f"File too large: {size_mb:.1f}MB (max {MAX_UPLOAD_MB}MB)"
 
     job_id = uuid.uuid4().hex
     paths = job_paths(job_id)
     paths["base"].mkdir(parents=True, exist_ok=True)
-    paths["input"].write_bytes(contents)
+    input_bytes = await save_upload(file, paths["input"])
+    if input_bytes is None:
+        shutil.rmtree(paths["base"], ignore_errors=True)
+        return None, f"File too large (max {MAX_UPLOAD_MB}MB)"
 
     original_name = safe_filename(file.filename or "document.pdf")
-    paths["meta"].write_text(
-        json.dumps(
+    paths["meta"].write_bytes(
+        orjson.dumps(
             {
                 "job_id": job_id,
                 "filename": original_name,
@@ -152,23 +289,18 @@ def create_job_from_upload(file: UploadFile, contents: bytes, lang: str, mode: s
                 "force_ocr": force_ocr,
                 "output_type": output_type,
                 "optimize": optimize,
-                "input_bytes": len(contents),
+                "input_bytes": input_bytes,
             },
-            indent=2,
-        ),
-        encoding="utf-8",
+            option=orjson.OPT_INDENT_2,
+        )
     )
 
     write_status(paths["status"], "queued")
 
-    t = threading.Thread(
-        target=run_job,
-        args=(job_id, lang, mode, force_ocr, output_type, optimize),
-        daemon=True,
-    )
-    t.start()
+    future = JOB_POOL.submit(run_job, job_id, lang, mode, force_ocr, output_type, optimize)
+    future.add_done_callback(lambda f: on_job_done(job_id, f))
 
-    return {"job_id": job_id, "filename": original_name, "input_bytes": len(contents)}, None
+    return {"job_id": job_id, "filename": original_name, "input_bytes": input_bytes}, None
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -200,12 +332,12 @@ def api_jobs():
         status = {}
         try:
             if meta_path.exists():
-                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+                meta = orjson.loads(meta_path.read_bytes())
         except Exception:
             meta = {}
         try:
             if status_path.exists():
-                status = json.loads(status_path.read_text(encoding="utf-8"))
+                status = orjson.loads(status_path.read_bytes())
         except Exception:
             status = {}
 
@@ -232,10 +364,9 @@ async def upload_pdf(
     output_type: str = Form("pdf"),
     optimize: str = Form("3"),
 ):
-    contents = await file.read()
-    job, err = create_job_from_upload(file, contents, lang, mode, force_ocr, output_type, optimize)
+    job, err = await create_job_from_upload(file, lang, mode, force_ocr, output_type, optimize)
     if err:
-        return JSONResponse({"error": err}, status_code=413)
+        return ORJSONResponse({"error": err}, status_code=413)
     return job
 
 
@@ -249,13 +380,12 @@ async def upload_pdf_batch(
     optimize: str = Form("3"),
 ):
     if not files:
-        return JSONResponse({"error": "No files provided"}, status_code=400)
+        return ORJSONResponse({"error": "No files provided"}, status_code=400)
 
     jobs = []
     errors = []
     for file in files:
-        contents = await file.read()
-        job, err = create_job_from_upload(file, contents, lang, mode, force_ocr, output_type, optimize)
+        job, err = await create_job_from_upload(file, lang, mode, force_ocr, output_type, optimize)
         if err:
             errors.append({
                 "filename": safe_filename(file.filename or "document.pdf"),
@@ -265,7 +395,7 @@ async def upload_pdf_batch(
         jobs.append(job)
 
     if not jobs:
-        return JSONResponse(
+        return ORJSONResponse(
             {"error": "No files were queued", "jobs": [], "errors": errors},
             status_code=413 if errors else 400,
         )
@@ -273,43 +403,83 @@ async def upload_pdf_batch(
     return {"jobs": jobs, "errors": errors}
 
 
+def not_modified(request: Request, etag: str, mtime_s: int) -> bool:
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        return inm.strip() == "*" or etag in (t.strip() for t in inm.split(","))
+    ims = request.headers.get("if-modified-since")
+    if ims and mtime_s:
+        parsed = parsedate_tz(ims)
+        return parsed is not None and mktime_tz(parsed) >= mtime_s
+    return False
+
+
 @app.get("/api/status/{job_id}")
-def status(job_id: str):
+def status(job_id: str, request: Request):
     paths = job_paths(job_id)
     if not paths["base"].exists():
-        return JSONResponse({"error": "Not found"}, status_code=404)
+        return ORJSONResponse({"error": "Not found"}, status_code=404)
+
+    # Stat before reading: a write landing mid-request changes a signature, so the next poll rebuilds.
+    key = (
+        file_sig(paths["status"]),
+        file_sig(paths["meta"]),
+        file_sig(paths["log"]),
+        paths["output_pdf"].exists(),
+    )
+    with STATUS_CACHE_LOCK:
+        cached = STATUS_CACHE.get(job_id)
 
-    status_obj = {}
-    meta_obj = {}
-    if paths["status"].exists():
-        status_obj = json.loads(paths["status"].read_text(encoding="utf-8"))
-    if paths["meta"].exists():
-        meta_obj = json.loads(paths["meta"].read_text(encoding="utf-8"))
+    if cached is not None and cached[0] == key:
+        _, body, state, etag = cached
+    else:
+        status_obj = {}
+        meta_obj = {}
+        if paths["status"].exists():
+            status_obj = orjson.loads(paths["status"].read_bytes())
+        if paths["meta"].exists():
+            meta_obj = orjson.loads(paths["meta"].read_bytes())
 
-    log_tail = ""
-    if paths["log"].exists():
-        lines = paths["log"].read_text(errors="ignore").splitlines()[-300:]
-        log_tail = "\n".join(lines)
+        log_tail = tail_lines(paths["log"]) if paths["log"].exists() else ""
 
-    return {
-        "job_id": job_id,
-        "status": status_obj,
-        "meta": meta_obj,
-        "has_output": paths["output_pdf"].exists(),
-        "log_tail": log_tail,
+        body = orjson.dumps(
+            {
+                "job_id": job_id,
+                "status": status_obj,
+                "meta": meta_obj,
+                "has_output": key[3],
+                "log_tail": log_tail,
+            }
+        )
+        state = status_obj.get("state")
+        etag = '"' + hashlib.sha1(repr(key).encode()).hexdigest()[:16] + '"'
+        with STATUS_CACHE_LOCK:
+            STATUS_CACHE[job_id] = (key, body, state, etag)
+
+    # Terminal states must still revalidate: a deleted job has to 404 rather than be served from browser cache.
+    headers = {
+        "Cache-Control": "private, no-cache" if state in ("done", "error") else "private, max-age=1",
+        "ETag": etag,
     }
+    newest = max(sig[0] for sig in key[:3]) // 1_000_000_000
+    # Only advertise seconds that are already over, so a later write in the same second can't hide behind a 304.
+    if newest and newest < int(time.time()):
+        headers["Last-Modified"] = formatdate(newest, usegmt=True)
+    if not_modified(request, etag, newest):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 @app.get("/api/download/{job_id}")
 def download(job_id: str):
     paths = job_paths(job_id)
     if not paths["output_pdf"].exists():
-        return JSONResponse({"error": "Output not ready"}, status_code=404)
+        return ORJSONResponse({"error": "Output not ready"}, status_code=404)
 
     original_name = "document.pdf"
     if paths["meta"].exists():
         try:
-            meta = json.loads(paths["meta"].read_text(encoding="utf-8"))
+            meta = orjson.loads(paths["meta"].read_bytes())
             original_name = meta.get("filename") or original_name
         except Exception:
             pass
@@ -325,7 +495,9 @@ def download(job_id: str):
 def delete(job_id: str):
     paths = job_paths(job_id)
     if not paths["base"].exists():
-        return JSONResponse({"error": "Not found"}, status_code=404)
+        return ORJSONResponse({"error": "Not found"}, status_code=404)
     shutil.rmtree(paths["base"], ignore_errors=True)
+    with STATUS_CACHE_LOCK:
+        STATUS_CACHE.pop(job_id, None)
     return {"ok": True}
 
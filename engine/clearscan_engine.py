@@ -11,37 +11,107 @@ ClearScan OSS (production v0.5.4) — Smart OCR + compression
 """
 
 import argparse
-import subprocess
+import asyncio
+import os
+import signal
+import tempfile
+import time
 from pathlib import Path
+from typing import TextIO
 
-def run_capture(cmd: list[str]) -> tuple[int, str]:
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    return p.returncode, (p.stdout or "")
+# ocrmypdf OCRs pages in parallel; keep this small since the web app runs several jobs at once.
+OCR_JOBS = int(os.getenv("OCR_JOBS", "2"))
+MODES = ("fast", "best")
+OUTPUT_TYPES = ("pdf", "pdfa-2")
+OPTIMIZE_LEVELS = ("0", "1", "2", "3")
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("pdf", type=Path)
-    ap.add_argument("--out", type=Path, required=True)
-    ap.add_argument("--lang", type=str, default="eng")
-    ap.add_argument("--mode", type=str, choices=["fast", "best"], default="best")
-    ap.add_argument("--force-ocr", action="store_true")
-    ap.add_argument("--output-type", type=str, default="pdf", choices=["pdf", "pdfa-2"])
-    ap.add_argument("--optimize", type=str, default="3", choices=["0","1","2","3"])
-    args = ap.parse_args()
+# Seconds one engine run may take across all ocrmypdf attempts (fallback retries share it); 0 disables the limit.
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "0"))
+# How long to wait for a killed ocrmypdf to be reaped before giving up on it.
+KILL_GRACE = 5.0
+
+async def run_capture_async(cmd: list[str], cwd: Path | None = None, timeout: float = 0) -> tuple[int, str]:
+    # Capture into a temp file rather than a pipe: a descendant that outlives ocrmypdf (or escapes its
+    # process group) can then hold the file open without ever blocking the wait below.
+    with tempfile.TemporaryFile() as capture:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            cwd=cwd,
+            stdout=capture,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=bool(timeout),
+        )
+        note = b""
+        try:
+            await asyncio.wait_for(proc.wait(), timeout or None)
+        except asyncio.TimeoutError:
+            if proc.returncode is None:
+                # Kill the whole group so ocrmypdf's tesseract/gs children don't keep running.
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                try:
+                    await asyncio.wait_for(proc.wait(), KILL_GRACE)
+                except asyncio.TimeoutError:
+                    pass
+                note = f"\n{cmd[0]} killed after {timeout:g}s timeout\n".encode()
+        capture.seek(0)
+        out = capture.read() + note
+    rc = proc.returncode if proc.returncode is not None else -signal.SIGKILL
+    return rc, out.decode(errors="ignore")
+
+def run_capture(cmd: list[str], cwd: Path | None = None, timeout: float = 0) -> tuple[int, str]:
+    return asyncio.run(run_capture_async(cmd, cwd=cwd, timeout=timeout))
+
+def process(
+    pdf: Path,
+    out: Path,
+    lang: str = "eng",
+    mode: str = "best",
+    force_ocr: bool = False,
+    output_type: str = "pdf",
+    optimize: str = "3",
+    jobs: int = OCR_JOBS,
+    timeout: float = OCR_TIMEOUT,
+    cwd: Path | None = None,
+    log: TextIO | None = None,
+) -> None:
+    deadline = time.monotonic() + timeout if timeout else None
+
+    def attempt(c: list[str]) -> tuple[int, str]:
+        remaining = 0.0
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"{c[0]} timeout of {timeout:g}s used up before retry")
+        if log is not None:
+            log.write("Running:\n" + " ".join(c) + "\n\n")
+            log.flush()
+        return run_capture(c, cwd=cwd, timeout=remaining)
 
-    inp = args.pdf.resolve()
-    out = args.out.resolve()
+    # The web app calls this directly with form values, so enforce the same choices argparse does.
+    for name, value, allowed in (
+        ("mode", mode, MODES),
+        ("output_type", output_type, OUTPUT_TYPES),
+        ("optimize", optimize, OPTIMIZE_LEVELS),
+    ):
+        if value not in allowed:
+            raise ValueError(f"invalid {name} {value!r} (choose from {', '.join(allowed)})")
+
+    inp = pdf.resolve()
+    out = out.resolve()
     out.parent.mkdir(parents=True, exist_ok=True)
 
-    base = ["ocrmypdf", "--optimize", args.optimize, "--jobs", "2", "--language", args.lang]
-    if not args.force_ocr:
+    base = ["ocrmypdf", "--optimize", optimize, "--jobs", str(jobs), "--language", lang]
+    if not force_ocr:
         base.append("--skip-text")
 
-    if args.mode == "best":
+    if mode == "best":
         base += ["--deskew", "--clean", "--rotate-pages"]
 
-    cmd = base + ["--output-type", args.output_type, str(inp), str(out)]
-    rc, txt = run_capture(cmd)
+    cmd = base + ["--output-type", output_type, str(inp), str(out)]
+    rc, txt = attempt(cmd)
     if rc == 0:
         return
 
@@ -50,7 +120,7 @@ def main():
     # unpaper missing -> drop --clean
     if "--clean" in cmd and "unpaper" in lower and ("was not found" in lower or "could not find program" in lower or "could not be executed" in lower):
         cmd2 = [c for c in cmd if c != "--clean"]
-        rc2, txt2 = run_capture(cmd2)
+        rc2, txt2 = attempt(cmd2)
         if rc2 == 0:
             return
         cmd, txt, lower = cmd2, txt2, txt2.lower()
@@ -62,12 +132,37 @@ def main():
             if tok == "--optimize" and i + 1 < len(cmd3):
                 cmd3[i+1] = "1"
                 break
-        rc3, txt3 = run_capture(cmd3)
+        rc3, txt3 = attempt(cmd3)
         if rc3 == 0:
             return
         txt = txt3
 
     raise RuntimeError(txt)
 
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pdf", type=Path)
+    ap.add_argument("--out", type=Path, required=True)
+    ap.add_argument("--lang", type=str, default="eng")
+    ap.add_argument("--mode", type=str, choices=MODES, default="best")
+    ap.add_argument("--force-ocr", action="store_true")
+    ap.add_argument("--output-type", type=str, default="pdf", choices=OUTPUT_TYPES)
+    ap.add_argument("--optimize", type=str, default="3", choices=OPTIMIZE_LEVELS)
+    ap.add_argument("--jobs", type=int, default=OCR_JOBS)
+    ap.add_argument("--timeout", type=float, default=OCR_TIMEOUT)
+    args = ap.parse_args()
+
+    process(
+        args.pdf,
+        args.out,
+        lang=args.lang,
+        mode=args.mode,
+        force_ocr=args.force_ocr,
+        output_type=args.output_type,
+        optimize=args.optimize,
+        jobs=args.jobs,
+        timeout=args.timeout,
+    )
+
 if __name__ == "__main__":
     main()